@@ -5,17 +5,24 @@ Telegram Stats Tracker Bot - FastAPI Version
 Using Firestore REST API with async HTTP requests
 """
 
-import json
+import asyncio
+import functools
 import logging
 import os
+import re
+import secrets
+import time
+from collections import OrderedDict, defaultdict
 from contextlib import asynccontextmanager
-from datetime import datetime, timedelta
-from typing import Any, Dict, List, Optional
+from datetime import UTC, datetime
+from typing import Any, Dict, List, Optional, Tuple
 
+import google.auth.crypt
+import google.auth.jwt
 import httpx
-import pytz
+import orjson
 from fastapi import FastAPI, HTTPException, Request
-from fastapi.responses import JSONResponse
+from fastapi.responses import ORJSONResponse, Response
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.error import TelegramError
 from telegram.ext import (
@@ -27,11 +34,42 @@ from telegram.ext import (
     filters,
 )
 
-from history_handlers import *
+from history_handlers import (
+    format_timestamp,
+    get_tz,
+    handle_delete_callback,
+    handle_history,
+    handle_history_f,
+    handle_r,
+    handle_recover_callback,
+    parse_timestamp,
+)
 
 logging.getLogger(__name__).setLevel(logging.INFO)
 logger = logging.getLogger(__name__)
 
+# How long queued writes wait so that bursts are coalesced into one commit
+WRITE_FLUSH_DELAY = 0.05
+
+# Firestore's limit on writes in a single documents:commit call
+MAX_COMMIT_WRITES = 500
+
+# Parsed user documents are served from memory for this long (seconds)
+USER_CACHE_TTL = 30.0
+USER_CACHE_MAX_ENTRIES = 10_000
+
+# Service-account access tokens for the Firestore REST API
+GOOGLE_TOKEN_URL = "https://oauth2.googleapis.com/token"
+FIRESTORE_SCOPE = "https://www.googleapis.com/auth/datastore"
+# Tokens last an hour; renew this many seconds before expiry
+TOKEN_REFRESH_MARGIN = 300.0
+
+# Upper bound on updates being processed concurrently in the background
+MAX_CONCURRENT_UPDATES = 256
+
+# Recently accepted update_ids, so Telegram's redeliveries aren't processed twice
+RECENT_UPDATE_IDS = 256
+
 
 async def handle_unrecognized_command(
     update: Update, context: ContextTypes.DEFAULT_TYPE
@@ -44,6 +82,10 @@ async def handle_unrecognized_command(
 async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Log the error and send a message to the user"""
     logger.error("Exception while handling an update:", exc_info=context.error)
+
+    # get_user hands out the cached document itself; a failed handler may have left it half-edited
+    if isinstance(update, Update) and update.effective_user and "db" in context.bot_data:
+        context.bot_data["db"].invalidate_user(str(update.effective_user.id))
     
     if isinstance(update, Update) and update.effective_message:
         # Avoid replying if it's already a failed callback query that might have been answered
@@ -68,22 +110,40 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
             logger.error(f"Failed to send error message: {e}")
 
 
-# timestamp Helper function
-def format_timestamp(iso_string: str, timezone: str = "UTC") -> str:
-    try:
-        dt = datetime.fromisoformat(iso_string.replace("Z", "+00:00"))
-        if dt.tzinfo is None:
-            dt = dt.replace(tzinfo=pytz.UTC)
-        try:
-            tz = pytz.timezone(timezone)
-        except pytz.exceptions.UnknownTimeZoneError:
-            logger.warning(f"Invalid timezone '{timezone}', falling back to UTC")
-            tz = pytz.UTC
-        dt = dt.astimezone(tz)
-        return dt.strftime("%b %d, %Y at %I:%M %p %Z")
-    except Exception as e:
-        logger.error(f"Error formatting timestamp: {e}")
-        return iso_string
+def _utcnow_iso() -> str:
+    """Current UTC time as ISO 8601 with a Z suffix, formatted without building a datetime"""
+    ns = time.time_ns()
+    t = time.gmtime(ns // 1_000_000_000)
+    return (
+        f"{t.tm_year:04d}-{t.tm_mon:02d}-{t.tm_mday:02d}"
+        f"T{t.tm_hour:02d}:{t.tm_min:02d}:{t.tm_sec:02d}.{ns // 1_000 % 1_000_000:06d}Z"
+    )
+
+
+# Field names Firestore accepts unquoted in a field path
+_SIMPLE_FIELD_NAME = re.compile(r"[A-Za-z_][A-Za-z_0-9]*")
+
+
+def _split_field_path(path: str) -> List[str]:
+    """Split a Firestore field path into names, undoing backtick quoting"""
+    names = []
+    name = ""
+    quoted = escaped = False
+    for ch in path:
+        if escaped:
+            name += ch
+            escaped = False
+        elif quoted and ch == "\\":
+            escaped = True
+        elif ch == "`":
+            quoted = not quoted
+        elif ch == "." and not quoted:
+            names.append(name)
+            name = ""
+        else:
+            name += ch
+    names.append(name)
+    return names
 
 
 class FirestoreDB:
@@ -94,24 +154,212 @@ class FirestoreDB:
             raise ValueError("FIREBASE_PROJECT_ID environment variable is required")
 
         self.base_url = f"https://firestore.googleapis.com/v1/projects/{self.project_id}/databases/(default)/documents"
-        self.client = httpx.AsyncClient(timeout=30.0)
+        self.document_prefix = f"projects/{self.project_id}/databases/(default)/documents"
+        # Created in connect() so it binds to the running event loop
+        self.client: Optional[httpx.AsyncClient] = None
+        self._pending_writes: Dict[str, List[Dict[str, Any]]] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        # user_id -> that user's latest commit task; each commit waits for the one before it
+        self._user_commits: Dict[str, asyncio.Task] = {}
+        # user_id -> (stored_at, document, digest of the document as last loaded/written)
+        self._cache: "OrderedDict[str, Tuple[float, Dict[str, Any], int]]" = OrderedDict()
+        self._user_locks: Dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+        # Coroutines holding or waiting on each user's lock; the lock is dropped when this hits zero
+        self._user_lock_users: Dict[str, int] = defaultdict(int)
+
+        # Service-account credentials are optional; without them requests are sent unauthenticated
+        self.client_email = os.getenv("FIREBASE_CLIENT_EMAIL")
+        private_key = os.getenv("FIREBASE_PRIVATE_KEY")
+        self._signer = None
+        if self.client_email and private_key:
+            # Env vars usually carry the PEM with escaped newlines
+            self._signer = google.auth.crypt.RSASigner.from_string(private_key.replace("\\n", "\n"))
+        self._token_task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def field_path(*names: str) -> str:
+        """Join field names into a Firestore field path, backtick-quoting any that need it.
+
+        Category and group names are user input, so e.g. "5k" or "body.fat" must be quoted
+        to be addressed as a single field in an updateMask.
+        """
+        return ".".join(
+            name if _SIMPLE_FIELD_NAME.fullmatch(name)
+            else "`" + name.replace("\\", "\\\\").replace("`", "\\`") + "`"
+            for name in names
+        )
+
+    async def connect(self) -> None:
+        """Create the HTTP client and warm its connection to Firestore"""
+        # One pooled HTTP/2 client so concurrent updates multiplex over a kept-alive connection
+        self.client = httpx.AsyncClient(
+            http2=True,
+            timeout=httpx.Timeout(10.0, connect=3.0),
+            limits=httpx.Limits(
+                max_connections=100,
+                max_keepalive_connections=50,
+                keepalive_expiry=30.0,
+            ),
+            headers={"Content-Type": "application/json"},
+        )
+        if self._signer is not None:
+            # First token before serving; after that it is renewed in the background
+            expires_in = await self._refresh_token()
+            self._token_task = asyncio.create_task(self._keep_token_fresh(expires_in))
+        # Pay DNS + TLS at startup instead of on the first user's request
+        try:
+            await self.client.head("https://firestore.googleapis.com/")
+        except httpx.HTTPError as e:
+            logger.warning(f"Firestore connection warm-up failed: {e}")
 
     async def close(self):
-        """Close the HTTP client"""
+        """Flush queued writes and close the HTTP client"""
+        await self.flush_writes()
+        if self._token_task is not None:
+            self._token_task.cancel()
         await self.client.aclose()
 
+    async def _refresh_token(self) -> float:
+        """Exchange a signed service-account JWT for an access token; returns its lifetime in seconds"""
+        now = int(time.time())
+        assertion = google.auth.jwt.encode(self._signer, {
+            "iss": self.client_email,
+            "scope": FIRESTORE_SCOPE,
+            "aud": GOOGLE_TOKEN_URL,
+            "iat": now,
+            "exp": now + 3600,
+        })
+        response = await self.client.post(
+            GOOGLE_TOKEN_URL,
+            data={
+                "grant_type": "urn:ietf:params:oauth:grant-type:jwt-bearer",
+                "assertion": assertion.decode(),
+            },
+            # Overrides the client's JSON default for this form-encoded request
+            headers={"Content-Type": "application/x-www-form-urlencoded"},
+        )
+        response.raise_for_status()
+        token = orjson.loads(response.content)
+        # Client-level header, so every Firestore request carries the current token
+        self.client.headers["Authorization"] = f"Bearer {token['access_token']}"
+        return float(token.get("expires_in", 3600))
+
+    async def _keep_token_fresh(self, expires_in: float) -> None:
+        """Renew the access token ahead of expiry so no request ever waits on it"""
+        delay = max(expires_in - TOKEN_REFRESH_MARGIN, 30.0)
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                delay = max(await self._refresh_token() - TOKEN_REFRESH_MARGIN, 30.0)
+            except Exception as e:
+                logger.error(f"Firestore token refresh failed: {e}")
+                delay = 30.0
+
     async def get_user(self, user_id: str) -> Dict[str, Any]:
-        """Get user data from Firestore using REST API"""
+        """Get user data from the cache, or from Firestore using REST API"""
+        cached = self._cache_get(user_id)
+        if cached is not None:
+            return cached
+
+        # Concurrent misses for the same user wait on one Firestore GET
+        lock = self._user_locks[user_id]
+        self._user_lock_users[user_id] += 1
         try:
-            response = await self.client.get(f"{self.base_url}/users/{user_id}")
-            if response.status_code == 404:
-                return {"stats": {}, "groups": {}, "timezone": "UTC"}
+            async with lock:
+                cached = self._cache_get(user_id)
+                if cached is not None:
+                    return cached
+
+                # Read-your-writes: this user's queued writes go out and in-flight commits land first
+                if user_id in self._pending_writes or user_id in self._user_commits:
+                    await self.flush_writes(user_id)
+                try:
+                    response = await self.client.get(f"{self.base_url}/users/{user_id}")
+                    if response.status_code == 404:
+                        user_data = {"stats": {}, "groups": {}, "timezone": "UTC"}
+                    else:
+                        response.raise_for_status()
+                        user_data = self.parse_document(orjson.loads(response.content))
+                except Exception as e:
+                    logger.error(f"Get user error: {e}")
+                    return {"stats": {}, "groups": {}, "timezone": "UTC"}
+
+                self._cache_put(user_id, user_data)
+                return user_data
+        finally:
+            # Only the last user of the lock drops it; waiters keep sharing the same one
+            self._user_lock_users[user_id] -= 1
+            if not self._user_lock_users[user_id]:
+                del self._user_lock_users[user_id]
+                del self._user_locks[user_id]
+
+    def invalidate_user(self, user_id: str) -> None:
+        """Drop a cached document, e.g. after a handler failed part-way through mutating it"""
+        self._cache.pop(user_id, None)
+
+    def _cache_get(self, user_id: str) -> Optional[Dict[str, Any]]:
+        item = self._cache.get(user_id)
+        if item is None:
+            return None
+        stored_at, user_data, _ = item
+        if time.monotonic() - stored_at >= USER_CACHE_TTL:
+            del self._cache[user_id]
+            return None
+        self._cache.move_to_end(user_id)
+        return user_data
+
+    @staticmethod
+    def _digest(user_data: Dict[str, Any]) -> int:
+        return hash(orjson.dumps(user_data, option=orjson.OPT_SORT_KEYS))
+
+    def _cache_put(self, user_id: str, user_data: Dict[str, Any]) -> None:
+        self._cache[user_id] = (time.monotonic(), user_data, self._digest(user_data))
+        self._cache.move_to_end(user_id)
+        while len(self._cache) > USER_CACHE_MAX_ENTRIES:
+            self._cache.popitem(last=False)
+
+    def _cache_mark_synced(self, user_id: str) -> None:
+        """Record the cached document's current state as what Firestore holds"""
+        item = self._cache.get(user_id)
+        if item is not None:
+            # Synced just now, so the TTL restarts
+            self._cache[user_id] = (time.monotonic(), item[1], self._digest(item[1]))
+
+    def _cache_apply_write(self, user_id: str, data: Dict[str, Any], field_paths: Optional[List[str]]) -> bool:
+        """Write-through: mirror a write onto the cached document.
+
+        Returns False when the document is unchanged from its last synced state, so the
+        write can be skipped. Handlers mutate the cached dict in place before writing,
+        which is why this compares digests rather than values.
+        """
+        if field_paths is None:
+            item = self._cache.get(user_id)
+            if item is not None and item[2] == self._digest(data):
+                return False
+            self._cache_put(user_id, data)
+            return True
+
+        cached = self._cache_get(user_id)
+        if cached is None:
+            return True
+        for path in field_paths:
+            *parents, leaf = _split_field_path(path)
+            source, target = data, cached
+            for part in parents:
+                source = source.get(part, {}) if isinstance(source, dict) else {}
+                target = target.setdefault(part, {})
+            # Same as Firestore: a masked field that is absent from the data is deleted
+            if isinstance(source, dict) and leaf in source:
+                target[leaf] = source[leaf]
+            else:
+                target.pop(leaf, None)
 
-            data = response.json()
-            return self.parse_document(data)
-        except Exception as e:
-            logger.error(f"Get user error: {e}")
-            return {"stats": {}, "groups": {}, "timezone": "UTC"}
+        digest = self._digest(cached)
+        if digest == self._cache[user_id][2]:
+            return False
+        # The document was just brought up to date, so the TTL restarts
+        self._cache[user_id] = (time.monotonic(), cached, digest)
+        return True
 
     async def set_user(self, user_id: str, data: Dict[str, Any]) -> None:
         """Set user data in Firestore using REST API (FULL OVERWRITE - Use sparingly)"""
@@ -119,48 +367,155 @@ class FirestoreDB:
             firestore_doc = self.to_firestore_document(data)
             response = await self.client.patch(
                 f"{self.base_url}/users/{user_id}",
-                headers={"Content-Type": "application/json"},
-                content=json.dumps({"fields": firestore_doc}),
+                content=orjson.dumps({"fields": firestore_doc}),
             )
             response.raise_for_status()
+            self._cache_put(user_id, data)
         except Exception as e:
+            self._cache.pop(user_id, None)
             logger.error(f"Set user error: {e}")
 
+    def queue_write(self, user_id: str, data: Dict[str, Any], field_paths: Optional[List[str]] = None) -> None:
+        """Queue a user write for the next batched commit (full overwrite unless field_paths is given)"""
+        # Mirror onto the cache first; writes that change nothing never leave the process
+        if not self._cache_apply_write(user_id, data, field_paths):
+            return
+
+        # Encode now so later mutations of `data` by the caller don't leak into the write
+        write = {
+            "update": {
+                "name": f"{self.document_prefix}/users/{user_id}",
+                "fields": self.to_firestore_document(data),
+            }
+        }
+        if field_paths is not None:
+            write["updateMask"] = {"fieldPaths": field_paths}
+
+        self._enqueue_write(user_id, write)
+
+    def _enqueue_write(self, user_id: str, write: Dict[str, Any]) -> None:
+        self._pending_writes.setdefault(user_id, []).append(write)
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self) -> None:
+        await asyncio.sleep(WRITE_FLUSH_DELAY)
+        self._flush_task = None
+        await self.flush_writes()
+
+    async def flush_writes(self, user_id: Optional[str] = None) -> None:
+        """Send queued writes (all users, or just one) as documents:commit calls and wait for them.
+
+        Also waits for commits already in flight (that user's, or everyone's).
+        """
+        if user_id is None:
+            pending, self._pending_writes = self._pending_writes, {}
+        else:
+            pending = {user_id: self._pending_writes.pop(user_id, [])}
+
+        # Commits are atomic, so each user gets their own: a write Firestore rejects (say a
+        # reserved __name__ field) fails only that user's commit, not everyone's in the window
+        for pending_user_id, writes in pending.items():
+            if writes:
+                self._start_user_commit(pending_user_id, writes)
+
+        # A user's newest commit runs after all their earlier ones, so waiting on it covers them too
+        if user_id is None:
+            tasks = list(self._user_commits.values())
+        else:
+            latest = self._user_commits.get(user_id)
+            tasks = [latest] if latest is not None else []
+        if tasks:
+            # wait() rather than gather(): a cancelled caller must not cancel the commits
+            await asyncio.wait(tasks)
+
+    def _start_user_commit(self, user_id: str, writes: List[Dict[str, Any]]) -> None:
+        """Schedule a user's writes to commit after any earlier commit of theirs still in flight"""
+        task = asyncio.create_task(self._commit_user(user_id, writes, self._user_commits.get(user_id)))
+        self._user_commits[user_id] = task
+        task.add_done_callback(functools.partial(self._user_commit_done, user_id))
+
+    def _user_commit_done(self, user_id: str, task: asyncio.Task) -> None:
+        if self._user_commits.get(user_id) is task:
+            del self._user_commits[user_id]
+
+    async def _commit_user(
+        self, user_id: str, writes: List[Dict[str, Any]], previous: Optional[asyncio.Task]
+    ) -> None:
+        """Commit one user's writes in order, at most MAX_COMMIT_WRITES per commit"""
+        # Firestore doesn't order independent requests: e.g. a stats.<cat> reset from /new
+        # overtaking the /add transform after it would drop the entry
+        if previous is not None:
+            await asyncio.wait([previous])
+        for start in range(0, len(writes), MAX_COMMIT_WRITES):
+            if not await self._commit(user_id, writes[start:start + MAX_COMMIT_WRITES]):
+                # Later writes may build on the rejected ones; the cache is dropped, so the next read refetches
+                return
+
+    async def _commit(self, user_id: str, writes: List[Dict[str, Any]]) -> bool:
+        try:
+            response = await self.client.post(
+                f"{self.base_url}:commit",
+                content=orjson.dumps({"writes": writes}),
+            )
+            response.raise_for_status()
+            return True
+        except Exception as e:
+            logger.error(f"Commit writes error for user {user_id} ({len(writes)} writes): {e}")
+            # The cache was written through optimistically; drop it so the next read refetches
+            self._cache.pop(user_id, None)
+            return False
+
     async def update_user_fields(self, user_id: str, data: Dict[str, Any], field_paths: List[str]) -> None:
         """Update specific fields in a user document using updateMask."""
+        # Mirror onto the cache before yielding, and always send: callers (/migrate) edit the cached
+        # document in place, and a handler running during the flush below would record that state
+        # as synced, so an unchanged-digest check here would skip a write Firestore never got
+        self._cache_apply_write(user_id, data, field_paths)
+        # This PATCH bypasses the write queue; anything queued or in flight lands first so it
+        # can't commit afterwards and overwrite these fields with older data
+        await self.flush_writes(user_id)
         try:
             firestore_doc = self.to_firestore_document(data)
             params = {"updateMask.fieldPaths": field_paths}
             response = await self.client.patch(
                 f"{self.base_url}/users/{user_id}",
                 params=params,
-                headers={"Content-Type": "application/json"},
-                content=json.dumps({"fields": firestore_doc}),
+                content=orjson.dumps({"fields": firestore_doc}),
             )
             response.raise_for_status()
         except Exception as e:
+            self._cache.pop(user_id, None)
             logger.error(f"Update user fields error: {e}")
             raise
 
-    async def add_entry(self, user_id: str, category: str, entry: Dict[str, Any]) -> None:
-        """Add an entry to a category. Uses Read-Modify-Write but restricted to the specific category."""
-        # Note: REST API array transforms are complex; using targeted updateMask as a major safety improvement
-        user_data = await self.get_user(user_id)
+    async def add_entry(
+        self, user_id: str, category: str, entry: Dict[str, Any], user_data: Optional[Dict[str, Any]] = None
+    ) -> None:
+        """Add an entry to a category with a server-side array append, so only the new entry is sent.
+
+        Pass the document the caller already loaded as `user_data` to skip reading it again.
+        """
+        if user_data is None:
+            user_data = await self.get_user(user_id)
         if category not in user_data["stats"]:
             raise ValueError(f"Category {category} does not exist")
-        
-        entries = user_data["stats"][category].get("entries", [])
-        entries.append(entry)
-        
-        # We only update the specific category's entries array
-        update_data = {
-            "stats": {
-                category: {
-                    "entries": entries
-                }
+
+        # appendMissingElements is applied by Firestore, so concurrent adds can't overwrite each other
+        self._enqueue_write(user_id, {
+            "transform": {
+                "document": f"{self.document_prefix}/users/{user_id}",
+                "fieldTransforms": [
+                    {
+                        "fieldPath": self.field_path("stats", category, "entries"),
+                        "appendMissingElements": {"values": [self.to_firestore_value(entry)]},
+                    }
+                ],
             }
-        }
-        await self.update_user_fields(user_id, update_data, [f"stats.{category}.entries"])
+        })
+        # Write-through: get_user hands back the cached document
+        user_data["stats"][category].setdefault("entries", []).append(entry)
+        self._cache_mark_synced(user_id)
 
     async def create_category(self, user_id: str, category: str) -> None:
         """Create a new category container."""
@@ -168,29 +523,32 @@ class FirestoreDB:
             "stats": {
                 category: {
                     "entries": [],
-                    "created_at": datetime.utcnow().isoformat() + "Z"
+                    "created_at": _utcnow_iso()
                 }
             }
         }
         # updateMask ensures we don't touch existing categories
-        await self.update_user_fields(user_id, update_data, [f"stats.{category}"])
+        self.queue_write(user_id, update_data, [self.field_path("stats", category)])
 
     async def delete_category(self, user_id: str, category: str) -> None:
         """Delete a category by removing it from the stats map."""
-        # In REST API, deleting a nested map key requires sending the whole parent or using updateMask
-        # However, simple way is to use the transform 'REMOVE' if supported, but here we use updateMask
-        # Actually, to delete a field in REST, we omit it from updateMask or use a specific syntax
-        # For now, we'll stick to the safer pattern of reading stats and writing back just stats
-        user_data = await self.get_user(user_id)
-        if "stats" in user_data and category in user_data["stats"]:
-            del user_data["stats"][category]
-            await self.update_user_fields(user_id, {"stats": user_data["stats"]}, ["stats"])
+        # A field named in the updateMask but absent from the data is deleted by Firestore,
+        # so this touches only stats.<category> and needs no read
+        self.queue_write(user_id, {"stats": {}}, [self.field_path("stats", category)])
 
     async def update_timezone(self, user_id: str, timezone: str) -> None:
-        await self.update_user_fields(user_id, {"timezone": timezone}, ["timezone"])
-
-    async def update_groups(self, user_id: str, groups: Dict[str, List[str]]) -> None:
-        await self.update_user_fields(user_id, {"groups": groups}, ["groups"])
+        self.queue_write(user_id, {"timezone": timezone}, ["timezone"])
+
+    async def update_group(self, user_id: str, group_name: str, groups: Dict[str, List[str]]) -> None:
+        """Write one group, or delete it if it is absent from `groups` (the user's full, updated groups map)."""
+        # _grouped_cats is a flat reverse index so /view doesn't walk every group on each click
+        grouped_cats = sorted({cat for cats in groups.values() if isinstance(cats, list) for cat in cats})
+        group_data = {group_name: groups[group_name]} if group_name in groups else {}
+        self.queue_write(
+            user_id,
+            {"groups": group_data, "_grouped_cats": grouped_cats},
+            [self.field_path("groups", group_name), "_grouped_cats"],
+        )
 
 
     def parse_document(self, doc):
@@ -198,57 +556,52 @@ class FirestoreDB:
         if "fields" not in doc:
             return {}
 
-        result = {}
-        for key, value in doc["fields"].items():
-            result[key] = self.parse_value(value)
-        return result
+        return {key: self.parse_value(value) for key, value in doc["fields"].items()}
 
     def parse_value(self, value):
         """Parse Firestore value types"""
-        if "stringValue" in value:
-            return value["stringValue"]
-        elif "integerValue" in value:
-            return int(value["integerValue"])
-        elif "doubleValue" in value:
-            return float(value["doubleValue"])
-        elif "booleanValue" in value:
-            return value["booleanValue"]
-        elif "mapValue" in value:
-            return self.parse_document(value["mapValue"])
-        elif "arrayValue" in value:
-            return [self.parse_value(v) for v in value["arrayValue"].get("values", [])]
+        # A Firestore value holds exactly one typed key; its parser is a single dict lookup
+        for kind, raw in value.items():
+            parser = _VALUE_PARSERS.get(kind)
+            return parser(self, raw) if parser is not None else None
         return None
 
     def to_firestore_document(self, obj):
         """Convert Python object to Firestore document"""
-        result = {}
-        for key, value in obj.items():
-            result[key] = self.to_firestore_value(value)
-        return result
+        return {key: self.to_firestore_value(value) for key, value in obj.items()}
 
     def to_firestore_value(self, value):
         """Convert Python value to Firestore value"""
-        if isinstance(value, str):
-            return {"stringValue": value}
-        elif isinstance(value, int):
-            return {"integerValue": value}
-        elif isinstance(value, float):
-            return {"doubleValue": value}
-        elif isinstance(value, bool):
-            return {"booleanValue": value}
-        elif isinstance(value, list):
-            return {
-                "arrayValue": {"values": [self.to_firestore_value(v) for v in value]}
-            }
-        elif isinstance(value, dict):
-            return {"mapValue": {"fields": self.to_firestore_document(value)}}
-        return {"nullValue": None}
-
-
-# Command handlers
-async def handle_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handle /start command"""
-    welcome_text = """🎯 *Welcome to Stats Tracker Bot!*
+        # Keyed on the exact type, so bools never fall into integerValue
+        encoder = _VALUE_ENCODERS.get(type(value))
+        if encoder is None:
+            return {"nullValue": None}
+        return encoder(self, value)
+
+
+# Firestore value key -> parser, used by FirestoreDB.parse_value
+_VALUE_PARSERS = {
+    "stringValue": lambda db, raw: raw,
+    "integerValue": lambda db, raw: int(raw),
+    "doubleValue": lambda db, raw: float(raw),
+    "booleanValue": lambda db, raw: raw,
+    "mapValue": lambda db, raw: db.parse_document(raw),
+    "arrayValue": lambda db, raw: [db.parse_value(v) for v in raw.get("values", [])],
+}
+
+# Python type -> encoder, used by FirestoreDB.to_firestore_value
+_VALUE_ENCODERS = {
+    str: lambda db, value: {"stringValue": value},
+    bool: lambda db, value: {"booleanValue": value},
+    int: lambda db, value: {"integerValue": value},
+    float: lambda db, value: {"doubleValue": value},
+    list: lambda db, value: {"arrayValue": {"values": [db.to_firestore_value(v) for v in value]}},
+    dict: lambda db, value: {"mapValue": {"fields": db.to_firestore_document(value)}},
+}
+
+
+# Fixed reply texts, built once at import
+WELCOME_TEXT = """🎯 *Welcome to Stats Tracker Bot!*
 
 Track any metric across all your devices:
 • Weight, workout reps, study hours
@@ -267,17 +620,43 @@ Track any metric across all your devices:
 /timezone - Set your timezone
 /help - Show this message"""
 
-    await update.message.reply_text(welcome_text, parse_mode="Markdown")
+NEW_USAGE = (
+    "Usage: /new <category_name>\n"
+    "Example: /new weight\n"
+    "Example: /new study_hours"
+)
+
+ADD_USAGE = (
+    "Usage: /add <category> <value> [note]\n"
+    "Example: /add weight 75.5\n"
+    "Example: /add workout 50 push-ups today"
+)
+
+# Filled with format_map(); note_block is empty when the entry has no note
+ADD_RESPONSE = "✅ Added to <b>{category}</b>: {value}{note_block}\n🕒 Recorded at: {recorded_at}"
+
+TZ_USAGE = (
+    "⏰ *Current timezone:* {current_tz}\n\n"
+    "Future entries will use this timezone.\n\n"
+    "To change, use: /timezone <timezone>\n\n"
+    "*Examples:*\n"
+    "/timezone Australia/Sydney\n"
+    "/timezone Asia/Ho_Chi_Minh\n"
+    "/timezone America/New_York\n\n"
+    "Full list: https://en.wikipedia.org/wiki/List_of_tz_database_time_zones"
+)
+
+
+# Command handlers
+async def handle_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle /start command"""
+    await update.message.reply_text(WELCOME_TEXT, parse_mode="Markdown")
 
 
 async def handle_new(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle /new command"""
     if not context.args:
-        await update.message.reply_text(
-            "Usage: /new <category_name>\n"
-            "Example: /new weight\n"
-            "Example: /new study_hours"
-        )
+        await update.message.reply_text(NEW_USAGE)
         return
 
     category = "_".join(context.args).lower()
@@ -302,11 +681,7 @@ async def handle_new(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
 async def handle_add(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Handle /add command"""
     if len(context.args) < 2:
-        await update.message.reply_text(
-            "Usage: /add <category> <value> [note]\n"
-            "Example: /add weight 75.5\n"
-            "Example: /add workout 50 push-ups today"
-        )
+        await update.message.reply_text(ADD_USAGE)
         return
 
     category = context.args[0].lower()
@@ -321,6 +696,7 @@ async def handle_add(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
     db = context.bot_data["db"]
 
     user_data = await db.get_user(user_id)
+    stats = user_data["stats"]
 
     # TIMEZONE ENFORCEMENT
     if "timezone" not in user_data or not user_data["timezone"]:
@@ -331,7 +707,7 @@ async def handle_add(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         )
         return
 
-    if category not in user_data["stats"]:
+    if category not in stats:
         await update.message.reply_text(
             f"❌ Category '{category}' doesn't exist.\n"
             f"Create it first with: /new {category}"
@@ -339,76 +715,79 @@ async def handle_add(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         return
 
     # Create timestamp in local timezone (NEW)
-    user_tz = pytz.timezone(user_data["timezone"])
-    local_time = datetime.now(pytz.UTC).astimezone(
-        user_tz
-    )  # Convert current UTC to local time
+    user_tz = get_tz(user_data["timezone"])
+    local_time = datetime.now(user_tz)
 
+    timestamp = local_time.isoformat()  # Local time with offset
     entry = {
         "value": value,
         "note": note,
-        "timestamp": local_time.isoformat(),  # Local time with offset
+        "timestamp": timestamp,
         "timezone": user_data["timezone"],  # Store timezone context
     }
 
-    await db.add_entry(user_id, category, entry)
-
-
-    response = f"✅ Added to <b>{category}</b>: {value}"
-    if note:
-        response += f"\n📝 Note: {note}"
+    await db.add_entry(user_id, category, entry, user_data)
 
     # Show the local time it was recorded
-    formatted_time = format_timestamp(local_time.isoformat(), user_data["timezone"])
-    response += f"\n🕒 Recorded at: {formatted_time}"
+    response = ADD_RESPONSE.format_map({
+        "category": category,
+        "value": value,
+        "note_block": f"\n📝 Note: {note}" if note else "",
+        "recorded_at": format_timestamp(timestamp, user_data["timezone"]),
+    })
 
     await update.message.reply_text(response, parse_mode="HTML")
 
 
-async def handle_view(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handle /view command"""
-    user_id = str(update.effective_user.id)
-    db = context.bot_data["db"]
+@functools.lru_cache(maxsize=1024)
+def _build_main_keyboard(ungrouped: Tuple[str, ...], group_names: Tuple[str, ...]) -> InlineKeyboardMarkup:
+    """Build the /view keyboard (cached: it only depends on the category and group names)"""
+    buttons = [[InlineKeyboardButton(f"📈 {cat}", callback_data=f"view_{cat}")] for cat in ungrouped]
+    buttons.extend(
+        [InlineKeyboardButton(f"🗂️ {group_name}", callback_data=f"viewgroup_{group_name}")]
+        for group_name in group_names
+    )
+    return InlineKeyboardMarkup(buttons)
 
-    user_data = await db.get_user(user_id)
-    all_stats = user_data["stats"]
-    all_groups = user_data["groups"]
 
-    # Collect all categories that belong to groups
-    grouped_cats = set()
-    for group_categories in all_groups.values():
-        if isinstance(group_categories, list):
-            grouped_cats.update(group_categories)
+def _main_keyboard(user_data: Dict[str, Any]) -> Optional[InlineKeyboardMarkup]:
+    """Keyboard of ungrouped categories and groups, or None if the user has neither"""
+    all_stats = user_data.get("stats", {})
+    all_groups = user_data.get("groups", {})
+
+    # Categories that belong to groups; documents written before the index existed fall back to a scan
+    if "_grouped_cats" in user_data:
+        grouped_cats = set(user_data["_grouped_cats"])
+    else:
+        grouped_cats = set()
+        for group_categories in all_groups.values():
+            if isinstance(group_categories, list):
+                grouped_cats.update(group_categories)
 
     # Ungrouped = categories not in any group
     ungrouped = [cat for cat in all_stats.keys() if cat not in grouped_cats]
 
-    # Construct buttons
-    buttons = []
+    if not ungrouped and not all_groups:
+        return None
+    return _build_main_keyboard(tuple(sorted(ungrouped)), tuple(sorted(all_groups.keys())))
 
-    # Add ungrouped categories
-    for cat in ungrouped:
-        buttons.append([InlineKeyboardButton(f"📈 {cat}", callback_data=f"view_{cat}")])
 
-    # Add groups
-    for group_name in all_groups.keys():
-        buttons.append(
-            [
-                InlineKeyboardButton(
-                    f"🗂️ {group_name}", callback_data=f"viewgroup_{group_name}"
-                )
-            ]
-        )
+async def handle_view(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle /view command"""
+    user_id = str(update.effective_user.id)
+    db = context.bot_data["db"]
+
+    user_data = await db.get_user(user_id)
+    keyboard = _main_keyboard(user_data)
 
     # Handle empty case
-    if not buttons:
+    if keyboard is None:
         await update.message.reply_text(
             "You don't have any categories or groups yet!\n"
             "Create one with: /new <name> or /group <group> <cat1> [cat2] ..."
         )
         return
 
-    keyboard = InlineKeyboardMarkup(buttons)
     await update.message.reply_text(
         "📊 *Your Stats and Groups:*\nSelect one to view details.",
         parse_mode="Markdown",
@@ -431,16 +810,18 @@ async def handle_delete(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
     db = context.bot_data["db"]
 
     user_data = await db.get_user(user_id)
+    stats = user_data["stats"]
+    groups = user_data.get("groups", {})
 
     # Check if it's a category
-    if target in user_data["stats"]:
+    if target in stats:
         await db.delete_category(user_id, target)
         await update.message.reply_text(f"✅ Deleted category: {target}")
 
     # Check if it's a group
-    elif "groups" in user_data and target in user_data["groups"]:
-        del user_data["groups"][target]
-        await db.update_groups(user_id, user_data["groups"])
+    elif target in groups:
+        del groups[target]
+        await db.update_group(user_id, target, groups)
         await update.message.reply_text(f"✅ Deleted group: {target}")
 
 
@@ -458,14 +839,7 @@ async def handle_timezone(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         current_tz = user_data.get("timezone", "Not set")
 
         await update.message.reply_text(
-            f"⏰ *Current timezone:* {current_tz}\n\n"
-            f"Future entries will use this timezone.\n\n"
-            f"To change, use: /timezone <timezone>\n\n"
-            f"*Examples:*\n"
-            f"/timezone Australia/Sydney\n"
-            f"/timezone Asia/Ho_Chi_Minh\n"
-            f"/timezone America/New_York\n\n"
-            f"Full list: https://en.wikipedia.org/wiki/List_of_tz_database_time_zones",
+            TZ_USAGE.format_map({"current_tz": current_tz}),
             parse_mode="Markdown",
         )
         return
@@ -481,10 +855,11 @@ async def handle_timezone(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         )
         return
 
-    user_data = await db.get_user(user_id)
+    # Load (or wait for an in-flight load of) the document first, so the write-through below
+    # lands on the cached copy instead of racing a GET that would cache the old timezone
+    await db.get_user(user_id)
     await db.update_timezone(user_id, timezone)
 
-
     await update.message.reply_text(
         f"✅ Timezone set to: *{timezone}*", parse_mode="Markdown"
     )
@@ -501,14 +876,20 @@ async def handle_group(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         return
 
     group_name = context.args[0].lower()
-    categories = [cat.lower() for cat in context.args[1:]]
 
     user_id = str(update.effective_user.id)
     db = context.bot_data["db"]
 
-    # Verify all categories exist
+    # Lower-case and verify all categories exist in a single pass
     user_data = await db.get_user(user_id)
-    missing_categories = [cat for cat in categories if cat not in user_data["stats"]]
+    stats = user_data["stats"]
+    categories = []
+    missing_categories = []
+    for arg in context.args[1:]:
+        cat = arg.lower()
+        categories.append(cat)
+        if cat not in stats:
+            missing_categories.append(cat)
 
     if missing_categories:
         await update.message.reply_text(
@@ -522,7 +903,7 @@ async def handle_group(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         user_data["groups"] = {}
     user_data["groups"][group_name] = categories
 
-    await db.update_groups(user_id, user_data["groups"])
+    await db.update_group(user_id, group_name, user_data["groups"])
 
     await update.message.reply_text(
         f"✅ Created group *{group_name}*\nContains: {', '.join(categories)}",
@@ -530,98 +911,94 @@ async def handle_group(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     )
 
 
-async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Handle callback queries from inline keyboards"""
+async def _callback_view(update: Update, context: ContextTypes.DEFAULT_TYPE, arg: str) -> None:
+    """view_main returns to the main view; view_<category> shows that category's history"""
     query = update.callback_query
-    await query.answer()
-
-    data = query.data
-    logger.info(f"GENERAL CALLBACK RECEIVED: {data}")  # ADD THIS LINE
-    user_id = str(update.effective_user.id)
-    db = context.bot_data["db"]
-
-    if data == "view_main":
-        # Return to main view
-        user_data = await db.get_user(user_id)
-        all_stats = user_data.get("stats", {})
-        all_groups = user_data.get("groups", {})
-
-        grouped_cats = set()
-        for group_categories in all_groups.values():
-            if isinstance(group_categories, list):
-                grouped_cats.update(group_categories)
-
-        ungrouped = [cat for cat in all_stats.keys() if cat not in grouped_cats]
 
-        buttons = []
-        for cat in ungrouped:
-            buttons.append(
-                [InlineKeyboardButton(f"📈 {cat}", callback_data=f"view_{cat}")]
-            )
+    if arg == "main":
+        user_id = str(update.effective_user.id)
+        user_data = await context.bot_data["db"].get_user(user_id)
+        keyboard = _main_keyboard(user_data)
 
-        for group_name in all_groups.keys():
-            buttons.append(
-                [
-                    InlineKeyboardButton(
-                        f"🗂️ {group_name}", callback_data=f"viewgroup_{group_name}"
-                    )
-                ]
-            )
-
-        if not buttons:
+        if keyboard is None:
             await query.edit_message_text(
                 "You don't have any categories or groups yet!\n"
                 "Create one with: /new <name> or /group <group> <cat1> [cat2] ..."
             )
             return
 
-        keyboard = InlineKeyboardMarkup(buttons)
         await query.edit_message_text(
             "📊 *Your Stats and Groups:*\nSelect one to view details.",
             parse_mode="Markdown",
             reply_markup=keyboard,
         )
-    elif data.startswith("view_"):
-        category = data.replace("view_", "")
-        # Set context.args so handle_history knows which category to show
-        context.args = [category]
-        # Delete the message with the buttons
-        await query.delete_message()
-        # Call the history handler, which will send a new message
-        await handle_history(update, context)
-
-    elif data.startswith("viewgroup_"):
-        group_name = data.replace("viewgroup_", "")
-        user_data = await db.get_user(user_id)
+        return
 
-        if group_name not in user_data["groups"]:
-            await query.edit_message_text(f"Group '{group_name}' not found.")
-            return
+    # Set context.args so handle_history knows which category to show
+    context.args = [arg]
+    # Delete the message with the buttons
+    await query.delete_message()
+    # Call the history handler, which will send a new message
+    await handle_history(update, context)
 
-        categories = user_data["groups"][group_name]
 
-        # Create buttons for each category in the group
-        buttons = []
-        for cat in categories:
-            buttons.append(
-                [InlineKeyboardButton(f"📈 {cat}", callback_data=f"view_{cat}")]
-            )
+async def _callback_view_group(update: Update, context: ContextTypes.DEFAULT_TYPE, group_name: str) -> None:
+    """viewgroup_<group> lists the group's categories"""
+    query = update.callback_query
+    user_id = str(update.effective_user.id)
+    user_data = await context.bot_data["db"].get_user(user_id)
+
+    if group_name not in user_data["groups"]:
+        await query.edit_message_text(f"Group '{group_name}' not found.")
+        return
+
+    categories = user_data["groups"][group_name]
 
-        # Add back button
+    # Create buttons for each category in the group
+    buttons = []
+    for cat in categories:
         buttons.append(
-            [
-                InlineKeyboardButton(
-                    "« Back to All Categories", callback_data="view_main"
-                )
-            ]
+            [InlineKeyboardButton(f"📈 {cat}", callback_data=f"view_{cat}")]
         )
 
-        keyboard = InlineKeyboardMarkup(buttons)
-        await query.edit_message_text(
-            f"📂 *Group: {group_name}*\n\nSelect a category to view its latest entry:",
-            parse_mode="Markdown",
-            reply_markup=keyboard,
-        )
+    # Add back button
+    buttons.append(
+        [
+            InlineKeyboardButton(
+                "« Back to All Categories", callback_data="view_main"
+            )
+        ]
+    )
+
+    keyboard = InlineKeyboardMarkup(buttons)
+    await query.edit_message_text(
+        f"📂 *Group: {group_name}*\n\nSelect a category to view its latest entry:",
+        parse_mode="Markdown",
+        reply_markup=keyboard,
+    )
+
+
+# Callback data is "<prefix>_<arg>"; the prefix selects the handler
+_CALLBACK_HANDLERS = {
+    "view": _callback_view,
+    "viewgroup": _callback_view_group,
+}
+
+
+async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Handle callback queries from inline keyboards"""
+    query = update.callback_query
+    await query.answer()
+
+    data = query.data
+    logger.debug("GENERAL CALLBACK RECEIVED: %s", data)
+
+    prefix, _, arg = data.partition("_")
+    handler = _CALLBACK_HANDLERS.get(prefix)
+    if handler is None:
+        logger.warning(f"Unhandled callback data: {data}")
+        return
+    await handler(update, context, arg)
 
 
 async def handle_migrate(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -653,7 +1030,11 @@ async def handle_migrate(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         detailed_errors = []
 
         # FIX: Make cutoff time timezone-aware (UTC)
-        cutoff_time = datetime(2025, 11, 1, 12, 0, 0, tzinfo=pytz.UTC)
+        cutoff_time = datetime(2025, 11, 1, 12, 0, 0, tzinfo=UTC)
+        hcmc_tz = get_tz("Asia/Ho_Chi_Minh")
+        # A local date on or after Nov 3 is past the cutoff in every UTC offset (up to +14:00),
+        # so those entries are skipped on a string compare without parsing
+        skip_from_date = "2025-11-03"
         logger.info(f"Migration cutoff time (UTC): {cutoff_time}")
 
         for category_name, category_data in user_data["stats"].items():
@@ -663,37 +1044,27 @@ async def handle_migrate(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             for i, entry in enumerate(category_data["entries"]):
                 try:
                     timestamp_str = entry["timestamp"]
-                    logger.info(
-                        f"Processing entry {i} in {category_name}: {timestamp_str}"
-                    )
-
-                    # Parse timestamp (already UTC-aware from the Z suffix)
-                    if timestamp_str.endswith("Z"):
-                        entry_time = datetime.fromisoformat(
-                            timestamp_str.replace("Z", "+00:00")
-                        ).replace(tzinfo=pytz.UTC)
-                    else:
-                        entry_time = datetime.fromisoformat(timestamp_str)
-                        # Ensure it's timezone-aware
-                        if entry_time.tzinfo is None:
-                            entry_time = entry_time.replace(tzinfo=pytz.UTC)
+                    if timestamp_str[:10] >= skip_from_date and timestamp_str[:4].isdigit():
+                        continue
+                    logger.debug("Processing entry %d in %s: %s", i, category_name, timestamp_str)
+
+                    entry_time = parse_timestamp(timestamp_str)
 
-                    logger.info(f"Parsed timestamp (UTC): {entry_time}")
+                    logger.debug("Parsed timestamp (UTC): %s", entry_time)
 
                     # FIX: Now both times are timezone-aware, comparison should work
                     is_before_cutoff = entry_time < cutoff_time
-                    logger.info(f"Before cutoff {cutoff_time}? {is_before_cutoff}")
+                    logger.debug("Before cutoff %s? %s", cutoff_time, is_before_cutoff)
 
                     if is_before_cutoff:
                         category_migrated += 1
-                        logger.info(f"Entry qualifies for migration")
+                        logger.debug("Entry qualifies for migration")
 
                         if not dry_run:
                             entry["timezone"] = "Asia/Ho_Chi_Minh"
-                            hcmc_tz = pytz.timezone("Asia/Ho_Chi_Minh")
                             entry_local_time = entry_time.astimezone(hcmc_tz)
                             entry["timestamp"] = entry_local_time.isoformat()
-                            logger.info(f"Migrated to: {entry['timestamp']}")
+                            logger.debug("Migrated to: %s", entry["timestamp"])
 
                 except Exception as e:
                     error_msg = f"Category '{category_name}', entry {i}, timestamp '{entry.get('timestamp', 'MISSING')}': {str(e)}"
@@ -703,6 +1074,9 @@ async def handle_migrate(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                     error_count += 1
 
             if category_migrated > 0 or category_errors > 0:
+                logger.info(
+                    f"Migration {category_name}: {category_migrated} qualifying, {category_errors} errors"
+                )
                 category_report.append(
                     f"• {category_name}: {category_migrated} migrated, {category_errors} errors"
                 )
@@ -753,6 +1127,23 @@ async def handle_migrate(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         )
 
 
+# PTB tries handlers in registration order, so the everyday commands come first
+COMMAND_HANDLERS = (
+    ("add", handle_add),
+    ("view", handle_view),
+    ("history", handle_history),
+    ("new", handle_new),
+    ("r", handle_r),
+    ("history_f", handle_history_f),
+    ("group", handle_group),
+    ("delete", handle_delete),
+    ("timezone", handle_timezone),
+    ("start", handle_start),
+    ("help", handle_start),
+    ("migrate", handle_migrate),
+)
+
+
 def create_application():
     """Create and configure the Telegram Bot Application"""
     token = os.getenv("TELEGRAM_BOT_TOKEN")
@@ -762,23 +1153,9 @@ def create_application():
     # Create application
     application = Application.builder().token(token).build()
 
-    # Add database to bot_data
-    application.bot_data["db"] = FirestoreDB()
-
     # Add handlers
-    application.add_handler(CommandHandler("start", handle_start))
-    application.add_handler(CommandHandler("help", handle_start))
-    application.add_handler(CommandHandler("new", handle_new))
-    application.add_handler(CommandHandler("add", handle_add))
-    application.add_handler(CommandHandler("view", handle_view))
-    application.add_handler(CommandHandler("history", handle_history))
-    application.add_handler(CommandHandler("history_f", handle_history_f))
-
-    application.add_handler(CommandHandler("r", handle_r))
-    application.add_handler(CommandHandler("delete", handle_delete))
-    application.add_handler(CommandHandler("timezone", handle_timezone))
-    application.add_handler(CommandHandler("group", handle_group))
-    application.add_handler(CommandHandler("migrate", handle_migrate))
+    for command, callback in COMMAND_HANDLERS:
+        application.add_handler(CommandHandler(command, callback))
 
     application.add_handler(
         MessageHandler(filters.COMMAND, handle_unrecognized_command)
@@ -815,14 +1192,26 @@ async def lifespan(app: FastAPI):
     # Startup
     logger.info("Starting up...")
     telegram_app = create_application()
+
+    # Add database to bot_data, connected on uvicorn's running loop
+    db = FirestoreDB()
+    await db.connect()
+    telegram_app.bot_data["db"] = db
+
     await telegram_app.initialize()
     await telegram_app.start()
     logger.info("Telegram application initialized and started")
 
+    app.state.update_semaphore = asyncio.Semaphore(MAX_CONCURRENT_UPDATES)
+    app.state.update_tasks = set()
+
     yield
 
     # Shutdown
     logger.info("Shutting down...")
+    # Let updates that were already accepted finish before tearing down
+    if app.state.update_tasks:
+        await asyncio.gather(*app.state.update_tasks, return_exceptions=True)
     if telegram_app:
         await telegram_app.stop()
         await telegram_app.shutdown()
@@ -833,39 +1222,89 @@ async def lifespan(app: FastAPI):
 
 
 # Initialize FastAPI app
-app = FastAPI(title="Telegram Stats Tracker Bot", lifespan=lifespan)
+app = FastAPI(
+    title="Telegram Stats Tracker Bot",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
+
+
+async def _safe_process_update(app: FastAPI, update: Update) -> None:
+    """Process an update in the background, logging instead of propagating failures"""
+    try:
+        async with app.state.update_semaphore:
+            await telegram_app.process_update(update)
+    except Exception as e:
+        logger.error(f"Update processing error: {e}", exc_info=True)
 
 
 # Webhook endpoint
+# Every accepted update gets the same acknowledgement, so it is serialized once
+_WEBHOOK_OK = orjson.dumps({"status": "ok"})
+_WEBHOOK_HEADERS = {"Cache-Control": "no-store"}
+
+_recent_update_ids: "OrderedDict[int, None]" = OrderedDict()
+
+
+def _is_duplicate_update(update_id: Optional[int]) -> bool:
+    """True if this update_id was accepted recently"""
+    return update_id is not None and update_id in _recent_update_ids
+
+
+def _remember_update(update_id: Optional[int]) -> None:
+    """Record an accepted update_id, dropping the oldest past RECENT_UPDATE_IDS"""
+    if update_id is None:
+        return
+    _recent_update_ids[update_id] = None
+    if len(_recent_update_ids) > RECENT_UPDATE_IDS:
+        _recent_update_ids.popitem(last=False)
+
+
 @app.post("/webhook")
 async def webhook(request: Request):
     """Handle Telegram webhook updates"""
-    try:
-        data = await request.json()
-        logger.info("Received webhook update")
+    if telegram_app is None:
+        raise HTTPException(status_code=503, detail="Bot not initialized")
 
-        if telegram_app is None:
-            raise HTTPException(status_code=503, detail="Bot not initialized")
+    try:
+        # orjson straight from the raw body, skipping Starlette's stdlib json path
+        data = orjson.loads(await request.body())
+        update_id = data.get("update_id")
+        logger.debug("Received webhook update %s", update_id)
+        if _is_duplicate_update(update_id):
+            return Response(content=_WEBHOOK_OK, media_type="application/json", headers=_WEBHOOK_HEADERS)
 
         update = Update.de_json(data, telegram_app.bot)
-        await telegram_app.process_update(update)
 
-        return JSONResponse(content={"status": "ok"})
+        # Acknowledge right away; handlers waiting on Firestore must not hold Telegram's request open
+        task = asyncio.create_task(_safe_process_update(request.app, update))
+        request.app.state.update_tasks.add(task)
+        task.add_done_callback(request.app.state.update_tasks.discard)
+        # Only once the update is scheduled: if parsing or scheduling fails, Telegram's retry must
+        # not be dropped as a duplicate. Nothing above awaits, so a concurrent copy can't slip past
+        _remember_update(update_id)
+
+        return Response(content=_WEBHOOK_OK, media_type="application/json", headers=_WEBHOOK_HEADERS)
     except Exception as e:
         logger.error(f"Webhook error: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail=str(e))
 
 
+# Health probes arrive constantly from the load balancer, so the bodies are built once
+_HEALTH_BODIES = {
+    ready: orjson.dumps({"status": "healthy", "bot_initialized": ready}) for ready in (True, False)
+}
+_HEALTH_HEADERS = {"Cache-Control": "max-age=1"}
+
+
 # Health check endpoint
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
-    return JSONResponse(
-        content={
-            "status": "healthy",
-            "bot_initialized": telegram_app is not None,
-            "timestamp": datetime.utcnow().isoformat(),
-        }
+    return Response(
+        content=_HEALTH_BODIES[telegram_app is not None],
+        media_type="application/json",
+        headers=_HEALTH_HEADERS,
     )
 
 
@@ -873,24 +1312,29 @@ async def health_check():
 @app.get("/")
 async def root():
     """Root endpoint"""
-    return JSONResponse(
+    return ORJSONResponse(
         content={
             "status": "Telegram Stats Bot is running!",
-            "timestamp": datetime.utcnow().isoformat(),
+            "timestamp": _utcnow_iso(),
         }
     )
 
 
 # Optional: Endpoint to set webhook (call this once after deployment)
 @app.post("/set-webhook")
-async def set_webhook(webhook_url: str):
-    """Set the Telegram webhook URL"""
+async def set_webhook(webhook_url: str, request: Request):
+    """Set the Telegram webhook URL (requires the X-Admin-Token header to match ADMIN_TOKEN)"""
+    admin_token = os.getenv("ADMIN_TOKEN")
+    supplied = request.headers.get("X-Admin-Token", "")
+    if not admin_token or not secrets.compare_digest(supplied.encode(), admin_token.encode()):
+        raise HTTPException(status_code=401, detail="Unauthorized")
+
     try:
         if telegram_app is None:
             raise HTTPException(status_code=503, detail="Bot not initialized")
 
         await telegram_app.bot.set_webhook(url=webhook_url)
-        return JSONResponse(content={"status": "success", "webhook_url": webhook_url})
+        return ORJSONResponse(content={"status": "success", "webhook_url": webhook_url})
     except Exception as e:
         logger.error(f"Set webhook error: {e}")
         raise HTTPException(status_code=500, detail=str(e))
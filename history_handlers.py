@@ -3,30 +3,125 @@ History-related command handlers for Stats Tracker Bot
 """
 
 import logging
-from datetime import datetime, timedelta
+from bisect import bisect_left
+from functools import lru_cache
+from datetime import UTC, datetime, timedelta
 from typing import Dict, List, Any
-import pytz
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import ContextTypes
 
 logger = logging.getLogger(__name__)
 
+@lru_cache(maxsize=512)
+def get_tz(name: str):
+    """Cached zone lookup; raises ZoneInfoNotFoundError/ValueError for bad names (failures aren't cached)"""
+    return ZoneInfo(name)
+
+
+def parse_timestamp(iso_string: str) -> datetime:
+    """Parse a stored ISO timestamp into an aware datetime; naive (old format) timestamps are UTC"""
+    # Python 3.11's C fromisoformat accepts the "Z" suffix directly
+    dt = datetime.fromisoformat(iso_string)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=UTC)
+    return dt
+
+
+_MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec')
+
+
+@lru_cache(maxsize=4096)
 def format_timestamp(iso_string: str, timezone: str = 'UTC') -> str:
-    """Format ISO timestamp to readable string using the provided timezone"""
+    """Format ISO timestamp to readable string using the provided timezone
+
+    Cached, since /history re-renders the same entries on every page and filter.
+    """
     try:
-        dt = datetime.fromisoformat(iso_string.replace('Z', '+00:00'))
+        dt = parse_timestamp(iso_string)
         try:
-            tz = pytz.timezone(timezone)
-        except pytz.exceptions.UnknownTimeZoneError:
+            tz = get_tz(timezone)
+        except (ZoneInfoNotFoundError, ValueError):
             logger.warning(f"Invalid timezone '{timezone}', falling back to UTC")
-            tz = pytz.UTC
+            tz = UTC
         dt = dt.astimezone(tz)
-        return dt.strftime('%b %d, %Y at %I:%M %p %Z')
+        # Same output as strftime('%b %d, %Y at %I:%M %p %Z') without parsing the format string
+        hour = dt.hour
+        return (
+            f"{_MONTHS[dt.month - 1]} {dt.day:02d}, {dt.year} at "
+            f"{(hour - 1) % 12 + 1:02d}:{dt.minute:02d} {'AM' if hour < 12 else 'PM'} {dt.tzname()}"
+        )
     except Exception as e:
         logger.error(f"Error formatting timestamp: {e}")
         return iso_string
 
 
+def timestamp_seconds(iso_string: str) -> float:
+    """Convert a stored ISO timestamp to POSIX seconds"""
+    return parse_timestamp(iso_string).timestamp()
+
+
+R_USAGE_FOOTER = (
+    "\nEnter: `/r <category> <indices> -s`\n"
+    "*Examples:*\n"
+    "`/r {category} 2 -s` - Soft delete entry #2\n"
+    "`/r {category} 1,3 -s` - Soft delete entries 1 & 3\n"
+    "`/r {category} 1-3 -s` - Soft delete entries 1,2,3\n"
+    "`/r {category} 2 -h` - Hard delete entry #2"
+)
+
+DAY_SEPARATOR = '─────────────────\n'
+MAX_MESSAGE_CHARS = 3500
+
+
+def _chunk_messages(header: str, day_texts) -> List[str]:
+    """Pack per-day blocks into messages of at most MAX_MESSAGE_CHARS, never splitting a day.
+
+    Pieces are joined once per message and sizes tracked as a running count, rather than
+    re-concatenating the growing message for every day.
+    """
+    messages = []
+    parts = [header]
+    size = len(header)
+    for text in day_texts:
+        if size + len(text) > MAX_MESSAGE_CHARS:
+            messages.append("".join(parts))
+            parts = []
+            size = 0
+        parts.append(text)
+        size += len(text)
+    if parts:
+        messages.append("".join(parts))
+    return messages
+
+
+def _history_lines(day_index: int, group_entries):
+    """Lines for one day of /history; group_entries holds (entry, category tag) pairs"""
+    if day_index > 0:
+        yield DAY_SEPARATOR
+    for entry, entry_category in group_entries:
+        tag = f"[{entry_category}] " if entry_category else ''
+        # Use entry's own timezone for display
+        formatted_time = format_timestamp(entry['timestamp'], entry.get('timezone', 'UTC'))
+        yield f"• {tag}{entry['value']} - {formatted_time}\n"
+        if entry.get('note'):
+            yield f"  _{entry['note']}_\n"
+
+
+def _full_history_lines(day_index: int, group_entries):
+    """Lines for one day of /history_f, marking soft-deleted entries"""
+    if day_index > 0:
+        yield DAY_SEPARATOR
+    for entry in group_entries:
+        is_deleted = entry.get('is_deleted', False)
+        status_emoji = "❌" if is_deleted else "✅"
+        tag = f"[{entry['category']}] " if 'category' in entry else ''
+        formatted_time = format_timestamp(entry['timestamp'], entry.get('timezone', 'UTC'))
+        note = f" - {entry['note']}" if entry.get('note') else ''
+        recover = " [🔄 Recover]" if is_deleted else ''
+        yield f"• {status_emoji} {tag}{entry['value']} - {formatted_time}{note}{recover}\n"
+
+
 
 
 
@@ -70,33 +165,57 @@ async def handle_history(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     db = context.bot_data['db']
 
     user_data = await db.get_user(user_id)
-    if not user_data['stats'] and not user_data['groups']:
+    stats = user_data['stats']
+    groups = user_data['groups']
+    if not stats and not groups:
         await update.effective_message.reply_text("You don't have any stats or groups yet!")
         return
 
     entries = []
-    is_group = category in user_data['groups']
+    # Source category of each entry, parallel to `entries` (None outside group views)
+    entry_categories = []
+    group_categories = groups.get(category)
+    is_group = group_categories is not None
+    category_data = None if is_group else stats.get(category)
 
     if is_group:
         # Get entries from all categories in the group
-        group_categories = user_data['groups'].get(category, [])
         for cat in group_categories:
-            if cat in user_data['stats']:
-                cat_entries = user_data['stats'][cat].get('entries', [])
-                for entry in cat_entries:
-                    entry_with_category = entry.copy()
-                    entry_with_category['category'] = cat
-                    entries.append(entry_with_category)
-        # Sort by timestamp
-        entries.sort(key=lambda x: x.get('timestamp', ''))
-    elif category in user_data['stats']:
-        entries = user_data['stats'][category].get('entries', [])
+            cat_data = stats.get(cat)
+            if cat_data is not None:
+                cat_entries = cat_data.get('entries', [])
+                entries.extend(cat_entries)
+                entry_categories.extend([cat] * len(cat_entries))
+    elif category_data is not None:
+        entries = category_data.get('entries', [])
+        entry_categories = [None] * len(entries)
     else:
         await update.effective_message.reply_text(f"❌ No category or group named '{category}'")
         return
 
-    entries = [entry for entry in entries if entry and not entry.get('is_deleted', False)]
+    # Parse each active entry's timestamp once into a column kept parallel to `entries`
+    timestamps = []
+    active_entries = []
+    active_categories = []
+    for entry, entry_category in zip(entries, entry_categories):
+        if not entry or entry.get('is_deleted', False):
+            continue
+        try:
+            timestamps.append(timestamp_seconds(entry['timestamp']))
+        except (KeyError, ValueError) as e:
+            logger.warning(f"Invalid timestamp format for entry: {entry.get('timestamp')} - {e}")
+            continue
+        active_entries.append(entry)
+        active_categories.append(entry_category)
+    entries = active_entries
+    entry_categories = active_categories
 
+    if is_group:
+        # Merge the group's categories into one timeline
+        order = sorted(range(len(entries)), key=timestamps.__getitem__)
+        entries = [entries[i] for i in order]
+        entry_categories = [entry_categories[i] for i in order]
+        timestamps = [timestamps[i] for i in order]
 
     if not entries:
         await update.effective_message.reply_text(f"ℹ️ No entries recorded for '{category}' yet.")
@@ -106,8 +225,8 @@ async def handle_history(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     if days_back is not None and days_forward is not None:
         # Get user timezone
         try:
-            user_tz = pytz.timezone(user_data['timezone'])
-        except pytz.exceptions.UnknownTimeZoneError:
+            user_tz = get_tz(user_data['timezone'])
+        except (ZoneInfoNotFoundError, ValueError):
             await update.effective_message.reply_text(
                 f"❌ Invalid timezone setting: '{user_data['timezone']}'\n"
                 f"Please set a valid timezone using /settimezone"
@@ -115,11 +234,11 @@ async def handle_history(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             return
 
         # Get current time in user's timezone
-        now_utc = datetime.utcnow().replace(tzinfo=pytz.UTC)
-        now_user = now_utc.astimezone(user_tz)
+        now_user = datetime.now(user_tz)
 
-        # Calculate date range in user's timezone
-        user_midnight = user_tz.localize(datetime(now_user.year, now_user.month, now_user.day))
+        # Calculate date range in user's timezone (zoneinfo resolves the offset per date, so
+        # the day arithmetic below stays on local midnight across DST changes)
+        user_midnight = datetime(now_user.year, now_user.month, now_user.day, tzinfo=user_tz)
 
         start_date = user_midnight - timedelta(days=abs(days_back))
         end_date = user_midnight - timedelta(days=days_forward)
@@ -128,106 +247,63 @@ async def handle_history(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         if days_forward <= 0:
             end_date += timedelta(days=1)
 
-        logger.info(f"Date range in user timezone: {start_date} to {end_date}")
-
-        filtered_entries = []
-        for entry in entries:
-            try:
-                # Parse timestamp with backward compatibility for both formats
-                timestamp_str = entry['timestamp']
-
-                # Handle both timezone-aware and naive timestamps
-                if timestamp_str.endswith('Z'):
-                    # UTC timestamp - make it timezone-aware
-                    entry_dt = datetime.fromisoformat(timestamp_str.replace('Z', '+00:00')).replace(tzinfo=pytz.UTC)
-                elif '+' in timestamp_str:
-                    # Already timezone-aware format
-                    entry_dt = datetime.fromisoformat(timestamp_str)
-                else:
-                    # Naive timestamp (old format) - assume UTC and make timezone-aware
-                    entry_dt = datetime.fromisoformat(timestamp_str).replace(tzinfo=pytz.UTC)
-
-                # Convert to user timezone for date comparison
-                entry_user_tz = entry_dt.astimezone(user_tz)
-
-                if start_date <= entry_user_tz < end_date:
-                    filtered_entries.append(entry)
-
-            except ValueError as e:
-                logger.warning(f"Invalid timestamp format for entry: {entry.get('timestamp')} - {e}")
-                continue
-
-
-
-
-        entries = filtered_entries
-
-
+        logger.debug("Date range in user timezone: %s to %s", start_date, end_date)
 
+        # Compare plain POSIX seconds instead of converting every entry into the user's timezone
+        start_ts = start_date.timestamp()
+        end_ts = end_date.timestamp()
 
-    # If no entries after filtering, show message
-    if not entries and days_back is not None and days_forward is not None:
-        await update.effective_message.reply_text(
-            f"ℹ️ No entries found for '{category}' in the specified date range.\n"
-            f"Try without date filters to see all entries."
-        )
-        return
+        # Entries are appended in time order and group views were sorted above, so the window is
+        # normally one slice found by binary search (the sortedness check runs in C)
+        if is_group or timestamps == sorted(timestamps):
+            lo = bisect_left(timestamps, start_ts)
+            hi = bisect_left(timestamps, end_ts)
+            entries = entries[lo:hi]
+            entry_categories = entry_categories[lo:hi]
+            timestamps = timestamps[lo:hi]
+        else:
+            in_range = [i for i, entry_ts in enumerate(timestamps) if start_ts <= entry_ts < end_ts]
+            entries = [entries[i] for i in in_range]
+            entry_categories = [entry_categories[i] for i in in_range]
+            timestamps = [timestamps[i] for i in in_range]
 
-    # If no entries at all (even without filtering)
-    if not entries:
-        await update.effective_message.reply_text(f"ℹ️ No entries recorded for '{category}' yet.")
-        return
+        # Unfiltered histories were checked for emptiness above, so only a date range can empty them here
+        if not entries:
+            await update.effective_message.reply_text(
+                f"ℹ️ No entries found for '{category}' in the specified date range.\n"
+                f"Try without date filters to see all entries."
+            )
+            return
 
     # Reverse to show newest first
     entries.reverse()
+    entry_categories.reverse()
+    timestamps.reverse()
 
     # Group entries by LOCAL date (not UTC)
     date_groups = []
     current_local_date = None
     current_group = []
 
-    for entry in entries:
-        # Get the entry's timezone and convert to local date
-        entry_tz = pytz.timezone(entry.get('timezone', 'UTC'))
-        entry_local_time = datetime.fromisoformat(entry['timestamp'].replace('Z', '+00:00')).astimezone(entry_tz)
-        entry_local_date = entry_local_time.date()
+    for entry, entry_category, entry_ts in zip(entries, entry_categories, timestamps):
+        # Local date straight from the parsed column, in the entry's own timezone
+        entry_tz = get_tz(entry.get('timezone', 'UTC'))
+        entry_local_date = datetime.fromtimestamp(entry_ts, entry_tz).date()
 
         if entry_local_date != current_local_date:
             if current_group:
                 date_groups.append((current_local_date, current_group))
             current_local_date = entry_local_date
             current_group = []
-        current_group.append(entry)
+        current_group.append((entry, entry_category))
 
     if current_group:
         date_groups.append((current_local_date, current_group))
 
     # Build messages with smart chunking
-    messages = []
-    current_message = f"📊 *History for {category}:*\n\n"
-
-    for i, (local_date, group_entries) in enumerate(date_groups):
-        group_text = ""
-        if i > 0:
-            group_text += '─────────────────\n'
-
-        for entry in group_entries:
-            tag = f"[{entry['category']}] " if 'category' in entry else ''
-            # Use entry's own timezone for display
-            entry_timezone = entry.get('timezone', 'UTC')
-            formatted_time = format_timestamp(entry['timestamp'], entry_timezone)
-            group_text += f"• {tag}{entry['value']} - {formatted_time}\n"
-            if entry.get('note'):
-                group_text += f"  _{entry['note']}_\n"
-
-        if len(current_message + group_text) > 3500 and current_message.strip():
-            messages.append(current_message)
-            current_message = ""
-
-        current_message += group_text
-
-    if current_message.strip():
-        messages.append(current_message)
+    messages = _chunk_messages(f"📊 *History for {category}:*\n\n", (
+        "".join(_history_lines(i, group_entries)) for i, (local_date, group_entries) in enumerate(date_groups)
+    ))
 
     # Send all messages
     for message in messages:
@@ -335,25 +411,15 @@ async def _show_entries_with_indices(update: Update, category: str, entries: Lis
     # Reverse to show newest first
     active_entries.reverse()
 
-    message = f"📋 Current entries for '{category}' (newest first):\n\n"
-
-
-
+    # Lines are collected and joined once; the list can cover the whole category
+    lines = [f"📋 Current entries for '{category}' (newest first):\n\n"]
     for i, entry in enumerate(active_entries, 1):
         formatted_time = format_timestamp(entry['timestamp'], entry.get('timezone', 'UTC'))
-        message += f"{i}. {entry['value']} - {formatted_time}"
-        if entry.get('note'):
-            message += f" - {entry['note']}"
-        message += "\n"
-
-    message += "\nEnter: `/r <category> <indices> -s`\n"
-    message += "*Examples:*\n"
-    message += "`/r {category} 2 -s` - Soft delete entry #2\n"
-    message += "`/r {category} 1,3 -s` - Soft delete entries 1 & 3\n"
-    message += "`/r {category} 1-3 -s` - Soft delete entries 1,2,3\n"
-    message += "`/r {category} 2 -h` - Hard delete entry #2"
+        note = f" - {entry['note']}" if entry.get('note') else ''
+        lines.append(f"{i}. {entry['value']} - {formatted_time}{note}\n")
+    lines.append(R_USAGE_FOOTER)
 
-    await update.message.reply_text(message, parse_mode='Markdown')
+    await update.message.reply_text("".join(lines), parse_mode='Markdown')
 
 
 
@@ -537,20 +603,18 @@ async def _show_deletion_confirmation(update: Update, category: str,
     delete_type = "soft" if delete_flag == '-s' else "hard"
     emoji = "🗑️" if delete_flag == '-s' else "💥"
 
-    message = f"{emoji} {delete_type.capitalize()} delete these {len(entries_to_delete)} entries from '{category}'?\n\n"
-
+    lines = [f"{emoji} {delete_type.capitalize()} delete these {len(entries_to_delete)} entries from '{category}'?\n\n"]
     for item in entries_to_delete:
         entry = item['entry']
         formatted_time = format_timestamp(entry['timestamp'], entry.get('timezone', 'UTC'))
-        message += f"• {entry['value']} - {formatted_time}"
-        if entry.get('note'):
-            message += f" - {entry['note']}"
-        message += "\n"
+        note = f" - {entry['note']}" if entry.get('note') else ''
+        lines.append(f"• {entry['value']} - {formatted_time}{note}\n")
 
     if delete_flag == '-s':
-        message += "\nSoft deleted entries can be recovered with /history_f"
+        lines.append("\nSoft deleted entries can be recovered with /history_f")
     else:
-        message += "\n⚠️ Hard deletion is PERMANENT and cannot be undone"
+        lines.append("\n⚠️ Hard deletion is PERMANENT and cannot be undone")
+    message = "".join(lines)
 
     # Create confirmation keyboard
     keyboard = [
@@ -590,7 +654,7 @@ async def handle_delete_callback(update: Update, context: ContextTypes.DEFAULT_T
     await query.answer()
 
     data = query.data
-    logger.info(f"DELETE CALLBACK RECEIVED: {data}")
+    logger.debug("DELETE CALLBACK RECEIVED: %s", data)
     user_id = str(update.effective_user.id)
     db = context.bot_data['db']
 
@@ -615,8 +679,8 @@ async def handle_delete_callback(update: Update, context: ContextTypes.DEFAULT_T
             deleted_count = 0
             entries_modified = False
 
-            logger.info(f"Processing {delete_flag} delete for category '{category}', indices: {storage_indices}")
-            logger.info(f"Total entries before: {len(entries)}")
+            logger.debug("Processing %s delete for category '%s', indices: %s", delete_flag, category, storage_indices)
+            logger.debug("Total entries before: %d", len(entries))
 
             if delete_flag == '-s':
                 # Soft delete - mark entries as deleted
@@ -625,7 +689,7 @@ async def handle_delete_callback(update: Update, context: ContextTypes.DEFAULT_T
                         entries[storage_idx]['is_deleted'] = True
                         entries_modified = True
                         deleted_count += 1
-                        logger.info(f"Soft deleted entry at index {storage_idx}: {entries[storage_idx]}")
+                        logger.debug("Soft deleted entry at index %d: %s", storage_idx, entries[storage_idx])
             else:  # -h
                 # Hard delete - create new list excluding the indices to delete
                 entries_to_keep = []
@@ -635,13 +699,13 @@ async def handle_delete_callback(update: Update, context: ContextTypes.DEFAULT_T
                     else:
                         entries_modified = True
                         deleted_count += 1
-                        logger.info(f"Hard deleted entry at index {i}")
+                        logger.debug("Hard deleted entry at index %d", i)
                 # Replace the entries list with the filtered list
                 user_data['stats'][category]['entries'] = entries_to_keep
 
             if entries_modified:
-                await db.set_user(user_id, user_data)
-                logger.info(f"Saved changes to database. Total entries after: {len(user_data['stats'][category]['entries'])}")
+                db.queue_write(user_id, {"stats": {category: user_data['stats'][category]}}, [db.field_path('stats', category)])
+                logger.info(f"Queued changes to database. Total entries after: {len(user_data['stats'][category]['entries'])}")
 
                 if delete_flag == '-s':
                     await query.edit_message_text(
@@ -656,6 +720,7 @@ async def handle_delete_callback(update: Update, context: ContextTypes.DEFAULT_T
                 await query.edit_message_text("❌ No entries were deleted. They may have been modified since confirmation.")
 
         except Exception as e:
+            db.invalidate_user(user_id)
             logger.error(f"Error processing deletion callback: {e}")
             logger.error(f"Callback data: {data}")
             logger.error(f"Parsed parts: category={category}, flag={delete_flag}, indices={storage_indices}")
@@ -701,13 +766,12 @@ async def handle_history_f(update: Update, context: ContextTypes.DEFAULT_TYPE) -
 
     for entry in entries:
         # Get the entry's timezone and convert to local date
-        entry_tz = pytz.timezone(entry.get('timezone', 'UTC'))
+        entry_tz = get_tz(entry.get('timezone', 'UTC'))
         timestamp = entry.get('timestamp')
         if not timestamp:
             continue
-            
-        entry_local_time = datetime.fromisoformat(timestamp.replace('Z', '+00:00')).astimezone(entry_tz)
-        entry_local_date = entry_local_time.date()
+
+        entry_local_date = datetime.fromtimestamp(timestamp_seconds(timestamp), entry_tz).date()
 
         if entry_local_date != current_local_date:
             if current_group:
@@ -719,43 +783,10 @@ async def handle_history_f(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     if current_group:
         date_groups.append((current_local_date, current_group))
 
-    # Build message with recovery buttons for deleted entries
-    messages = []
-    current_message = f"📊 *Full History for {category}:*\n\n"
-
-    for i, (local_date, group_entries) in enumerate(date_groups):
-        group_text = ""
-        if i > 0:
-            group_text += '─────────────────\n'
-
-        for entry in group_entries:
-            is_deleted = entry.get('is_deleted', False)
-            status_emoji = "❌" if is_deleted else "✅"
-
-            tag = f"[{entry['category']}] " if 'category' in entry else ''
-            formatted_time = format_timestamp(entry['timestamp'], entry.get('timezone', 'UTC'))
-
-            group_text += f"• {status_emoji} {tag}{entry['value']} - {formatted_time}"
-
-            if entry.get('note'):
-                group_text += f" - {entry['note']}"
-
-            # Add recovery button for deleted entries
-            if is_deleted:
-                # Find the entry index for recovery
-                entry_index = entries.index(entry)
-                group_text += f" [🔄 Recover]"
-
-            group_text += "\n"
-
-        if len(current_message + group_text) > 3500 and current_message.strip():
-            messages.append(current_message)
-            current_message = ""
-
-        current_message += group_text
-
-    if current_message.strip():
-        messages.append(current_message)
+    # Build message with recovery markers for deleted entries
+    messages = _chunk_messages(f"📊 *Full History for {category}:*\n\n", (
+        "".join(_full_history_lines(i, group_entries)) for i, (local_date, group_entries) in enumerate(date_groups)
+    ))
 
     # Send all messages (for now without actual buttons - we'll add callback later)
     for message in messages:
@@ -1,25 +1,34 @@
 import sys
 from datetime import datetime
 
+HEADER_PREFIX = b"# Real Linecount :"
+
 def count_nonblank_lines(filepath):
-    with open(filepath, 'r', encoding='utf-8') as f:
-        lines = f.readlines()
-    nonblank_lines = [line for line in lines if line.strip()]
-    return len(nonblank_lines), lines
+    # Stream the file in bytes: nothing is held in memory and nothing needs decoding
+    with open(filepath, 'rb') as f:
+        return sum(1 for line in f if line.strip())
 
 def write_header(filepath, count):
     timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    header = f"# Real Linecount : {count} as of {timestamp}\n"
+    header = f"# Real Linecount : {count} as of {timestamp}\n".encode('utf-8')
 
-    count, lines = count_nonblank_lines(filepath)
-    # Avoid stacking multiple headers if re-run
-    if lines and lines[0].startswith("# Real Linecount :"):
-        lines[0] = header
-    else:
-        lines.insert(0, header)
+    with open(filepath, 'r+b') as f:
+        first = f.readline()
+        # Avoid stacking multiple headers if re-run
+        has_header = first.startswith(HEADER_PREFIX)
+        if has_header and len(first) == len(header):
+            # Same length, so only the first line needs rewriting
+            f.seek(0)
+            f.write(header)
+            return
 
-    with open(filepath, 'w', encoding='utf-8') as f:
-        f.writelines(lines)
+        rest = f.read()
+        if not has_header:
+            rest = first + rest
+        f.seek(0)
+        f.write(header)
+        f.write(rest)
+        f.truncate()
 
 if __name__ == "__main__":
     if len(sys.argv) != 2:
@@ -28,7 +37,7 @@ if __name__ == "__main__":
 
     path = sys.argv[1]
     try:
-        count, _ = count_nonblank_lines(path)
+        count = count_nonblank_lines(path)
         write_header(path, count)
         print(f"Updated '{path}' with line count {count}.")
     except FileNotFoundError: